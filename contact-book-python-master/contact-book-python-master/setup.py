@@ -4,7 +4,7 @@
 from setuptools import setup
 
 setup(name='contactbook',
-      version='0.0.1',
+      version='0.1.0',
       description='A simple Python implementation of a personal address book',
       url='https://github.com/ninadpage/contact-book-python',
       author='Ninad Page',
@@ -15,7 +15,6 @@ setup(name='contactbook',
       },
       test_suite='tests',
       install_requires=[
-          'SQLAlchemy==1.0.14',
-          'PyTrie==0.2',
+          'SQLAlchemy>=2.0',
       ]
       )
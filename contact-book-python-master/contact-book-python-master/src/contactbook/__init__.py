@@ -3,6 +3,7 @@
 
 import logging
 import logging.config
+import os
 import sys
 
 from .db import db_init as _db_init
@@ -11,10 +12,10 @@ from .db import ContactBookDB
 
 __all__ = ['__version__', 'init_contactbook', 'ContactBookDB']
 
-__version__ = '0.0.1'
+__version__ = '0.1.0'
 
 
-def init_contactbook(*, sqlite_db_path=None, db_connection_string=None, logger=None):
+def init_contactbook(*, sqlite_db_path=None, db_connection_string=None, logger=None, engine_options=None):
     """
     Initializes Contact Book library (database connections, logging, etc).
     All parameters must be names explicitly. Only one of sqlite_db_path and db_connection_string must be provided.
@@ -25,7 +26,11 @@ def init_contactbook(*, sqlite_db_path=None, db_connection_string=None, logger=N
     If you want to use any other database engine, you can specify appropriate db_connection_string.
     Do not use an existing database, you might lose existing tables!
 
-    If logger is not provided, it creates a logger which emits to stdout at DEBUG level.
+    If logger is not provided, it creates a logger which emits to stdout at DEBUG level (or at the level given by
+    environment variable CONTACTBOOK_LOG_LEVEL).
+
+    Connection pool is configured with sensible defaults for the database engine used. These (or any other
+    keyword arguments of sqlalchemy.create_engine) can be overridden using engine_options.
 
     :param sqlite_db_path: Path to sqlite database file
     :type sqlite_db_path: str
@@ -34,37 +39,47 @@ def init_contactbook(*, sqlite_db_path=None, db_connection_string=None, logger=N
     :type db_connection_string: str
     :param logger: Logger object which will be used by this package for all logging
     :type logger: logging.Logger
+    :param engine_options: Keyword arguments for sqlalchemy.create_engine (see
+                           http://docs.sqlalchemy.org/en/latest/core/engines.html#engine-creation-api)
+    :type engine_options: dict
     :return: None
     """
 
     if logger:
         cb_logger = logger
     else:
-        # Create a logger which emits to stdout, with log level DEBUG
-        logging_config = {
-            'version': 1,
-            'formatters': {
-                'extended': {
-                    'format': '[%(asctime)s] [%(name)s] [%(levelname)s]: %(message)s',
+        cb_logger = logging.getLogger('cb_logger')
+        # Configure the logger only once, calling this function again must not add duplicate handlers
+        if not cb_logger.handlers:
+            # Create a logger which emits to stdout, with log level DEBUG (unless overridden by environment
+            # variable CONTACTBOOK_LOG_LEVEL)
+            level = os.environ.get('CONTACTBOOK_LOG_LEVEL', 'DEBUG').upper()
+            logging_config = {
+                'version': 1,
+                # Don't disable loggers of the application using this library
+                'disable_existing_loggers': False,
+                'formatters': {
+                    'extended': {
+                        'format': '[%(asctime)s] [%(name)s] [%(levelname)s]: %(message)s',
+                    },
                 },
-            },
-            'handlers': {
-                'stdout': {
-                    'level': 'DEBUG',
-                    'class': 'logging.StreamHandler',
-                    'formatter': 'extended',
-                    'stream': sys.stdout,
+                'handlers': {
+                    'stdout': {
+                        'level': level,
+                        'class': 'logging.StreamHandler',
+                        'formatter': 'extended',
+                        'stream': sys.stdout,
+                    },
                 },
-            },
-            'loggers': {
-                'cb_logger': {
-                    'handlers': ['stdout'],
-                    'level': 'DEBUG',
+                'loggers': {
+                    'cb_logger': {
+                        'handlers': ['stdout'],
+                        'level': level,
+                    },
                 },
-            },
-        }
+            }
 
-        logging.config.dictConfig(logging_config)
-        cb_logger = logging.getLogger('cb_logger')
+            logging.config.dictConfig(logging_config)
 
-    _db_init(db_logger=cb_logger, sqlite_db_path=sqlite_db_path, db_connection_string=db_connection_string)
+    _db_init(db_logger=cb_logger, sqlite_db_path=sqlite_db_path, db_connection_string=db_connection_string,
+             engine_options=engine_options)
@@ -2,37 +2,105 @@
 # Author: ninadpage
 
 import functools
-import traceback
 import sqlite3
-from sqlalchemy import create_engine, event
-from sqlalchemy.engine import Engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event, inspect, select, bindparam, func
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.orm import scoped_session, sessionmaker, load_only, lazyload, raiseload, selectinload
 from sqlalchemy.exc import SQLAlchemyError
 
 from .exceptions import NoSuchObjectFound
-from .models import Base, Person, Address, PhoneNumber, EmailAddress, Group
-from .fast_lookup import FastTrieLookup, FastLookupValue
+from .models import Base, Person, Address, PhoneNumber, EmailAddress, Group, PersonGroupAssociation
+from .fast_lookup import FastTrieLookup, FastLookupValue, normalize_name
 
 
 sqlalchemy_database_url = None
 sqlalchemy_engine = None
 sqlalchemy_sessionmaker = None
 logger = None
+# Whether the database deletes fields & group memberships of a deleted person (and memberships of a deleted group)
+# itself (tables created before their foreign keys were declared with ON DELETE CASCADE don't)
+database_cascades_deletes = True
 
 fast_trie_lookup = FastTrieLookup()
 
+# Query options which load all collections of persons, each with a single additional query
+_load_person_collections = (selectinload(Person.phone_numbers), selectinload(Person.email_addresses),
+                            selectinload(Person.addresses), selectinload(Person.groups))
+
+# Statement of ContactBookDB.get_persons_by_email, built only once. Persons are looked up by ids of the matching
+# addresses (found with a range scan on the index of lower-cased email), instead of checking addresses of every person.
+# Both sides are lower-cased by the database, so that they are lower-cased the same way.
+_select_persons_by_email_prefix = select(Person).options(*_load_person_collections).where(Person.id.in_(
+    select(EmailAddress.person_id).where(func.lower(EmailAddress.email) >= func.lower(bindparam('email_from')),
+                                         func.lower(EmailAddress.email) < func.lower(bindparam('email_to')))))
+
 
-@event.listens_for(Engine, "connect")
 def set_sqlite_pragma(dbapi_connection, connection_record):
     # Enable Foreign Key support for sqlite
     if isinstance(dbapi_connection, sqlite3.Connection):
         cursor = dbapi_connection.cursor()
         cursor.execute("PRAGMA foreign_keys=ON")
+        # Every ContactBookDB write is a small single-row transaction. With the default rollback journal and
+        # synchronous=FULL, each of those commits fsyncs the journal, which dominates write time. WAL with
+        # synchronous=NORMAL is still safe against corruption on power loss, but only syncs on checkpoints.
+        cursor.execute("PRAGMA journal_mode=WAL")
+        journal_mode = cursor.fetchone()[0]
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        # 256 MB memory-mapped I/O, 16 MB page cache (negative value is in KiB) and in-memory temp tables
+        cursor.execute("PRAGMA mmap_size=268435456")
+        cursor.execute("PRAGMA cache_size=-16384")
+        cursor.execute("PRAGMA temp_store=MEMORY")
         cursor.close()
+        if logger:
+            # In-memory databases can't use WAL, sqlite silently keeps journal_mode=memory for them
+            logger.debug('sqlite connection opened with journal_mode=%s', journal_mode)
+
+
+def _default_engine_options(database_url):
+    """
+    Returns options (connection pool, compiled statement cache size) for the engine of given database URL.
+
+    Pool is bounded, and hands out the most recently returned connection first (LIFO), so that surplus
+    connections stay idle and can be recycled, instead of all of them being kept in rotation.
+    For database servers, connections are also checked for liveness before use (so that connections dropped by
+    the server while idle don't surface as errors) and recycled after 30 minutes.
+    """
+    url = make_url(database_url)
+    # Keep compiled forms of more (than default 500) statements, as ContactBookDB issues the same few statements
+    # for many different models and loader options
+    options = {'query_cache_size': 1200}
+    if url.drivername.startswith('sqlite'):
+        if not url.database or url.database == ':memory:':
+            # In-memory database lives only as long as its connection, so keep SQLAlchemy's default pool which
+            # holds on to it
+            return options
+        # SQLAlchemy before 2.0 doesn't pool sqlite file connections at all (so every session would open the
+        # database file again), and 2.0 only keeps 5 of them (overflow ones are closed when returned); size the pool
+        # like for database servers instead. Pooled connections may be used by other threads than the one which
+        # created them.
+        options.update({
+            'poolclass': QueuePool,
+            'pool_size': 10,
+            'max_overflow': 20,
+            'pool_timeout': 30,
+            'pool_use_lifo': True,
+            'connect_args': {'check_same_thread': False},
+        })
+    else:
+        options.update({
+            'pool_size': 10,
+            'max_overflow': 20,
+            'pool_timeout': 30,
+            'pool_recycle': 1800,
+            'pool_pre_ping': True,
+            'pool_use_lifo': True,
+        })
+    return options
 
 
-def db_init(*, db_logger, sqlite_db_path=None, db_connection_string=None):
-    global sqlalchemy_database_url, sqlalchemy_engine, sqlalchemy_sessionmaker, logger
+def db_init(*, db_logger, sqlite_db_path=None, db_connection_string=None, engine_options=None):
+    global sqlalchemy_database_url, sqlalchemy_engine, sqlalchemy_sessionmaker, logger, database_cascades_deletes
 
     logger = db_logger
 
@@ -40,46 +108,102 @@ def db_init(*, db_logger, sqlite_db_path=None, db_connection_string=None):
         raise ValueError('Only one of sqlite_db_path and connection_string must be provided')
 
     if sqlite_db_path:
-        import sqlite3
-        # Create given sqlite database if it doesn't exist
-        sqlite3.connect(sqlite_db_path)
+        # Given sqlite database is created (if it doesn't exist) by the first connection to it
         _db_connection_string = 'sqlite:///{}'.format(sqlite_db_path)
     elif db_connection_string:
         _db_connection_string = db_connection_string
     else:
         raise ValueError('One of sqlite_db_path and connection_string must be provided')
 
+    previous_engine = sqlalchemy_engine
+
     sqlalchemy_database_url = _db_connection_string
-    sqlalchemy_engine = create_engine(sqlalchemy_database_url)
-    sqlalchemy_sessionmaker = sessionmaker(bind=sqlalchemy_engine)
+    _engine_options = _default_engine_options(sqlalchemy_database_url)
+    if engine_options:
+        _engine_options.update(engine_options)
+    sqlalchemy_engine = create_engine(sqlalchemy_database_url, **_engine_options)
+    # Only connections of this engine are configured, other sqlite engines of the application are left alone
+    event.listen(sqlalchemy_engine, 'connect', set_sqlite_pragma)
+    # Thread-local session registry (see sqlalchemy_session). Objects are not expired on commit, so that objects
+    # returned by ContactBookDB methods (which are committed and detached before returning) stay readable.
+    sqlalchemy_sessionmaker = scoped_session(sessionmaker(bind=sqlalchemy_engine, expire_on_commit=False))
 
     Base.metadata.create_all(sqlalchemy_engine)
+    database_cascades_deletes = _cascades_deletes(sqlalchemy_engine)
+    if not database_cascades_deletes:
+        logger.warning('Foreign keys of fields and group memberships are not declared with ON DELETE CASCADE, they '
+                       'are loaded and deleted one by one along with their person or group')
     init_lookup_trie_with_existing_persons()
 
+    # Close connections of the previous initialization, only now that the new engine has connected (an in-memory
+    # database shared by both lives only as long as any connection to it is open)
+    if previous_engine is not None:
+        previous_engine.dispose()
+
+
+def _cascades_deletes(engine):
+    """
+    Returns whether all foreign keys of fields (phone numbers, etc) and group memberships are declared with
+    ON DELETE CASCADE. Tables which already exist aren't altered by create_all, so this isn't the case for tables
+    created before.
+    """
+    inspector = inspect(engine)
+    for model in (Address, PhoneNumber, EmailAddress, PersonGroupAssociation):
+        for foreign_key in inspector.get_foreign_keys(model.__tablename__):
+            if (foreign_key['options'].get('ondelete') or '').upper() != 'CASCADE':
+                return False
+    return True
+
 
 def init_lookup_trie_with_existing_persons():
     """
     Feeds existing person records into lookup trie.
 
+    Only name columns are fetched with a Core select (streamed in batches, without an ORM session or creating
+    Person objects), and the trie is built in bulk from them.
+
     :return: None
     """
-    cb = ContactBookDB()
-    persons = cb.get_all_persons()
-    for person in persons:
-        fast_trie_lookup.add_person(person)
+    persons = Person.__table__
+    statement = select(persons.c.id, persons.c.title, persons.c.first_name, persons.c.middle_name,
+                       persons.c.last_name, persons.c.suffix).execution_options(yield_per=1000)
+    with sqlalchemy_engine.connect() as connection:
+        rows = connection.execute(statement)
+        fast_trie_lookup.build((person_id, Person.make_full_name(*names), names) for person_id, *names in rows)
 
 
-def sqlalchemy_session(commit=False, expunge=False, close_session=False):
+@functools.lru_cache(maxsize=1024)
+def _find_merged_person_details_by_prefix(prefix, trie_version):
     """
-    Decorator for ContactBookDB methods, which creates a SQLAlchemy session, rolls back in case of any exception and
-    disposes it off after use. The session is available as `self.session` inside the method which adds this decorator.
-
-    One problem with this decorator is, since it overwrites self.session every time it is invoked,
-    you cannot call one decorated method from other decorated method, as the latter invocation will
-    overwrite prior invocation's session.
-    So what if you want to cleanly manipulate two objects from same method, but without letting their sessions
-    mix? You can use `extra_sessions` parameter. It'll create a list of sessions of given length, available
-    as `self.sessions`. Note that these sessions are read-only, they cannot be committed.
+    Cached implementation of ContactBookDB._find_person_details_by_prefix. trie_version is only used as part of
+    the cache key.
+    """
+    result = fast_trie_lookup.get_persons_by_prefix(prefix)
+    # result is a list of dicts, will possible duplicates as there may be multiple paths to a single
+    # person (e.g. via common prefix of first name & last name). We need to merge all results to remove
+    # duplicates.
+    merged = {}
+    for d in result:
+        merged.update(d)
+    return merged
+
+
+# Results cached for previous versions of trie are never looked up again, so don't keep them around (each of them
+# can be as large as the whole contact book). trie_version stays part of the cache key, so that a result computed
+# concurrently with a modification isn't served for the new version.
+fast_trie_lookup.on_modified = _find_merged_person_details_by_prefix.cache_clear
+
+
+def sqlalchemy_session():
+    """
+    Decorator for ContactBookDB methods, which provides a SQLAlchemy session, commits after the method returns,
+    rolls back in case of any exception and disposes it off after use. The session is available as
+    `self.session` inside the method which adds this decorator.
+
+    Sessions come from a thread-local registry, and the thread's session is closed and removed from it after every
+    call, so that its connection goes back to the pool and the next call doesn't see objects (or changes to them)
+    of previous calls. Objects loaded in the session are detached then; as they aren't expired on commit, their
+    loaded attributes stay readable without querying them again.
     """
     global sqlalchemy_sessionmaker
 
@@ -88,24 +212,21 @@ def sqlalchemy_session(commit=False, expunge=False, close_session=False):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             self = args[0]
-            if self.session is None:
-                self.session = sqlalchemy_sessionmaker()
+            self.session = sqlalchemy_sessionmaker()
 
             try:
                 ret_value = func(*args, **kwargs)
-            except SQLAlchemyError as e:
+                self.session.commit()
+            except Exception as e:
+                # Changes of a failed call must not be left pending, even if the commit itself failed
                 self.session.rollback()
-                logger.error('Exception in SQLAlchemy session: {}\n{}'.format(e, traceback.format_exc()))
+                if isinstance(e, SQLAlchemyError):
+                    # Message (and traceback) is only formatted if the logger emits it
+                    logger.exception('Exception in SQLAlchemy session: %s', e)
                 raise
-            else:
-                if commit:
-                    self.session.commit()
-                if expunge:
-                    self.session.expunge_all()
             finally:
-                if close_session:
-                    self.session.close()
-                    self.session = None
+                sqlalchemy_sessionmaker.remove()
+                self.session = None
 
             return ret_value
         return wrapper
@@ -117,7 +238,37 @@ class ContactBookDB(object):
     def __init__(self):
         self.session = None
 
-    @sqlalchemy_session(commit=True)
+    def _get_by_id(self, model, object_id, *options):
+        """
+        Returns object of given model class with given id, loaded using given query options (e.g. eager loading
+        strategies for its relationships). Raises NoSuchObjectFound if no such object exists.
+        Must be called from a method decorated with sqlalchemy_session.
+        """
+        obj = self.session.get(model, object_id, options=options)
+        if obj is None:
+            raise NoSuchObjectFound(model.__name__, object_id)
+        return obj
+
+    def _check_exists(self, model, object_id):
+        """
+        Checks that object of given model class with given id exists, with a query of just its id (instead of
+        loading the whole object and its eagerly loaded relationships). Raises NoSuchObjectFound if it doesn't.
+        Must be called from a method decorated with sqlalchemy_session.
+        """
+        if self.session.query(model.id).filter(model.id == object_id).scalar() is None:
+            raise NoSuchObjectFound(model.__name__, object_id)
+
+    def _add_field(self, person_id, field):
+        """
+        Adds given new field (phone number, email address, etc) to person with given id, and returns it.
+        Must be called from a method decorated with sqlalchemy_session.
+        """
+        self._check_exists(Person, person_id)
+        field.person_id = person_id
+        self.session.add(field)
+        return field
+
+    @sqlalchemy_session()
     def create_person(self, title=None, first_name=None, middle_name=None, last_name=None, *, suffix=None,
                       phone_number=None, phone_label=None, email_address=None, email_label=None,
                       group_id=None):
@@ -151,29 +302,29 @@ class ContactBookDB(object):
         """
 
         if any([first_name, middle_name, last_name]):
+            # Look up the group before adding anything to the session, so that nothing is left pending in the
+            # session if it doesn't exist
+            group = self._get_by_id(Group, group_id) if group_id else None
+
+            phone_numbers = [PhoneNumber(phone=phone_number, label=phone_label)] if phone_number else []
+            email_addresses = [EmailAddress(email=email_address, label=email_label)] if email_address else []
+            # All collections are set (even if empty), so that they are loaded in the returned (detached) person.
+            # Fields and group association are added to session along with the person.
             person = Person(title=title, first_name=first_name, middle_name=middle_name, last_name=last_name,
-                            suffix=suffix)
+                            suffix=suffix, phone_numbers=phone_numbers, email_addresses=email_addresses, addresses=[],
+                            groups=[group] if group else [])
             self.session.add(person)
-            if phone_number:
-                phone = PhoneNumber(person=person, phone=phone_number, label=phone_label)
-                self.session.add(phone)
-            if email_address:
-                email = EmailAddress(person=person, email=email_address, label=email_label)
-                self.session.add(email)
-            if group_id:
-                group = self.session.query(Group).get(group_id)
-                if group is None:
-                    raise NoSuchObjectFound('Group', group_id)
-                person.groups.append(group)
-
-            # Intermediary commit to refresh the person object so that it gets updated with id
-            self.session.commit()
+
+            # Flush (but don't commit yet, the decorator does that only once) so that person gets updated with id.
+            # The unit of work inserts the person first and then its fields & group association, one INSERT per
+            # table (rows of the same table are batched into a single INSERT), without any additional SELECTs.
+            self.session.flush()
             fast_trie_lookup.add_person(person)
             return person
         else:
             raise ValueError('At least one of first_name, middle_name and last_name must be specified')
 
-    @sqlalchemy_session(commit=True)
+    @sqlalchemy_session()
     def create_group(self, name):
         """
         Adds a new group.
@@ -200,9 +351,7 @@ class ContactBookDB(object):
         :return: Person object
         :rtype: models.Person
         """
-        person = self.session.query(Person).get(person_id)
-        if person is None:
-            raise NoSuchObjectFound('Person', person_id)
+        person = self._get_by_id(Person, person_id)
         return person
 
     @sqlalchemy_session()
@@ -215,12 +364,12 @@ class ContactBookDB(object):
         :return: Group object
         :rtype: models.Group
         """
-        group = self.session.query(Group).get(group_id)
-        if group is None:
-            raise NoSuchObjectFound('Group', group_id)
+        # Members aren't loaded along with groups by default, but they can't be loaded later on the returned
+        # (detached) group
+        group = self._get_by_id(Group, group_id, selectinload(Group.persons))
         return group
 
-    @sqlalchemy_session(commit=True)
+    @sqlalchemy_session()
     def add_group_to_person(self, person_id, group_id):
         """
         Adds group specified by group_id to person specified by person_id.
@@ -231,15 +380,11 @@ class ContactBookDB(object):
         :type group_id: int
         :return: None
         """
-        person = self.session.query(Person).get(person_id)
-        if person is None:
-            raise NoSuchObjectFound('Person', person_id)
-        group = self.session.query(Group).get(group_id)
-        if group is None:
-            raise NoSuchObjectFound('Group', group_id)
-        person.groups.append(group)
+        self._check_exists(Person, person_id)
+        self._check_exists(Group, group_id)
+        self.session.add(PersonGroupAssociation(person_id=person_id, group_id=group_id))
 
-    @sqlalchemy_session(commit=True)
+    @sqlalchemy_session()
     def add_phone_number(self, person_id, phone_number, phone_label=None):
         """
         Adds a new phone number to person specified by person_id.
@@ -255,14 +400,9 @@ class ContactBookDB(object):
         """
         if not phone_number:
             raise ValueError('Phone number must be specified')
-        person = self.session.query(Person).get(person_id)
-        if person is None:
-            raise NoSuchObjectFound('Person', person_id)
-        phone = PhoneNumber(person=person, phone=phone_number, label=phone_label)
-        self.session.add(phone)
-        return phone
-
-    @sqlalchemy_session(commit=True)
+        return self._add_field(person_id, PhoneNumber(phone=phone_number, label=phone_label))
+
+    @sqlalchemy_session()
     def add_email_address(self, person_id, email_address, email_label=None):
         """
         Adds a new email address to person specified by person_id.
@@ -278,14 +418,9 @@ class ContactBookDB(object):
         """
         if not email_address:
             raise ValueError('Email address must be specified')
-        person = self.session.query(Person).get(person_id)
-        if person is None:
-            raise NoSuchObjectFound('Person', person_id)
-        email = EmailAddress(person=person, email=email_address, label=email_label)
-        self.session.add(email)
-        return email
-
-    @sqlalchemy_session(commit=True)
+        return self._add_field(person_id, EmailAddress(email=email_address, label=email_label))
+
+    @sqlalchemy_session()
     def add_address(self, person_id, house_number=None, street_name=None, address_line_1=None,
                     address_line_2=None, city=None, postal_code=None, country=None, address_label=None):
         """
@@ -315,16 +450,12 @@ class ContactBookDB(object):
 
         if not any([house_number, street_name, address_line_1, address_line_2, city, postal_code, country]):
             raise ValueError('At least one address field must be specified')
-        person = self.session.query(Person).get(person_id)
-        if person is None:
-            raise NoSuchObjectFound('Person', person_id)
-        address = Address(person=person, house_number=house_number, street_name=street_name,
-                          address_line_1=address_line_1, address_line_2=address_line_2, city=city,
-                          postal_code=postal_code, country=country, label=address_label)
-        self.session.add(address)
-        return address
-
-    @sqlalchemy_session(commit=True)
+        return self._add_field(person_id, Address(house_number=house_number, street_name=street_name,
+                                                  address_line_1=address_line_1, address_line_2=address_line_2,
+                                                  city=city, postal_code=postal_code, country=country,
+                                                  label=address_label))
+
+    @sqlalchemy_session()
     def delete_person(self, person_id):
         """
         Deletes a person and all associated fields (phone numbers, email addresses, etc).
@@ -334,16 +465,17 @@ class ContactBookDB(object):
         :type person_id: int
         :return: None
         """
-        person = self.session.query(Person).get(person_id)
-        if person is None:
-            raise NoSuchObjectFound('Person', person_id)
+        # The database deletes associated rows from other tables (phone_numbers, addresses, etc) with ON DELETE
+        # CASCADE, so collections aren't loaded. Otherwise the session deletes them, which needs them loaded.
+        options = (lazyload('*'),) if database_cascades_deletes else _load_person_collections
+        person = self._get_by_id(Person, person_id, *options)
+        self.session.delete(person)
+        # Flush before updating lookup trie, so that it isn't updated if deletion fails
+        self.session.flush()
         # Also delete the person from lookup trie
         fast_trie_lookup.remove_person(person)
-        # cascade clause used in defining relationships in models will take care of deleting associated
-        # rows from other tables (phone_numbers, addresses, person_group_associations, etc).
-        self.session.delete(person)
 
-    @sqlalchemy_session(commit=True)
+    @sqlalchemy_session()
     def delete_group(self, group_id):
         """
         Deletes a group. The group is also removed from the persons who were part of this group.
@@ -352,14 +484,13 @@ class ContactBookDB(object):
         :type group_id: int
         :return: None
         """
-        group = self.session.query(Group).get(group_id)
-        if group is None:
-            raise NoSuchObjectFound('Group', group_id)
-        # cascade clause used in defining relationships in models will take care of deleting associated rows
-        # from person_group_associations table.
+        # The database deletes associated rows from person_group_associations table with ON DELETE CASCADE.
+        # Otherwise the session deletes them, which needs members loaded.
+        options = () if database_cascades_deletes else (selectinload(Group.persons),)
+        group = self._get_by_id(Group, group_id, *options)
         self.session.delete(group)
 
-    @sqlalchemy_session(commit=True)
+    @sqlalchemy_session()
     def delete_phone_number(self, phone_number_id):
         """
         Deletes a phone number.
@@ -368,12 +499,10 @@ class ContactBookDB(object):
         :type phone_number_id: int
         :return: None
         """
-        phone = self.session.query(PhoneNumber).get(phone_number_id)
-        if phone is None:
-            raise NoSuchObjectFound('PhoneNumber', phone_number_id)
+        phone = self._get_by_id(PhoneNumber, phone_number_id)
         self.session.delete(phone)
 
-    @sqlalchemy_session(commit=True)
+    @sqlalchemy_session()
     def delete_email_address(self, email_address_id):
         """
         Deletes an email address.
@@ -382,12 +511,10 @@ class ContactBookDB(object):
         :type email_address_id: int
         :return: None
         """
-        email = self.session.query(EmailAddress).get(email_address_id)
-        if email is None:
-            raise NoSuchObjectFound('EmailAddress', email_address_id)
+        email = self._get_by_id(EmailAddress, email_address_id)
         self.session.delete(email)
 
-    @sqlalchemy_session(commit=True)
+    @sqlalchemy_session()
     def delete_address(self, address_id):
         """
         Deletes an address.
@@ -396,12 +523,10 @@ class ContactBookDB(object):
         :type address_id: int
         :return: None
         """
-        address = self.session.query(Address).get(address_id)
-        if address is None:
-            raise NoSuchObjectFound('Address', address_id)
+        address = self._get_by_id(Address, address_id)
         self.session.delete(address)
 
-    @sqlalchemy_session(commit=True)
+    @sqlalchemy_session()
     def save_object(self, obj):
         """
         Writes in-memory changes done to an SQLAlchemy object to database.
@@ -412,38 +537,57 @@ class ContactBookDB(object):
         :rtype: sqlalchemy.ext.declarative.api.Base
         """
         # Updating Person object is tricky, because we also need to update lookup trie,
-        # but for that we need old name attributes of Person.
-        if isinstance(obj, Person):
-            # Using new session to read existing (before updating) data of person
-            global sqlalchemy_sessionmaker
-            session = sqlalchemy_sessionmaker()
-            old_person = session.query(Person).get(obj.id)
-            if old_person is None:
+        # but for that we need old name attributes of Person. Lookup trie keeps track of those itself.
+        is_person = isinstance(obj, Person)
+        # merge loads the existing row, or makes a new pending object if there is none
+        merged = self.session.merge(obj)
+        if is_person:
+            if inspect(merged).pending:
                 raise NoSuchObjectFound('Person', obj.id)
-            fast_trie_lookup.remove_person(old_person)
-
-        self.session.merge(obj)
-        if isinstance(obj, Person):
-            fast_trie_lookup.add_person(obj)
+            # Flush before updating lookup trie, so that it isn't updated if saving fails
+            self.session.flush()
+            # Trie is only modified if any name is changed (and not when e.g. only phone numbers are)
+            fast_trie_lookup.update_person(obj)
         return obj
 
     @sqlalchemy_session()
-    def get_all_persons(self, group_id=None):
+    def get_all_persons(self, group_id=None, only_names=False):
         """
         Returns all persons. Optionally filters based on given group_id.
 
+        If only_names is True, only id and name attributes of persons are loaded, and accessing related fields
+        (phone numbers, groups, etc) raises an exception instead of silently querying them for each person.
+
         :param group_id: Group id to filter persons on
         :type group_id: int
+        :param only_names: Load only name attributes
+        :type only_names: bool
         :return: List of persons
         :rtype: <list (models.Person)>
         """
         query = self.session.query(Person)
-        if group_id:
-            query = query.filter(Person.groups.any(id=group_id))
-        result = query.all()
+        if only_names:
+            query = query.options(load_only(Person.id, Person.title, Person.first_name, Person.middle_name,
+                                            Person.last_name, Person.suffix),
+                                  raiseload('*'))
+        else:
+            query = query.options(*_load_person_collections)
         # This query result is detached from session by the decorator, so that
         # the caller can safely manipulate it
-        return result
+        return self._filter_persons_by_group(query, group_id).all()
+
+    @staticmethod
+    def _filter_persons_by_group(query, group_id):
+        """
+        Helper method for get_all_persons, which filters given query for persons on given group_id (if any).
+        """
+        if group_id:
+            # Join only the association table, so that the database looks up members by group_id in its index
+            # instead of checking every person for a matching group. Person.groups itself is still loaded with all
+            # of a person's groups, not just the filtered one.
+            query = query.join(PersonGroupAssociation, PersonGroupAssociation.person_id == Person.id).filter(
+                PersonGroupAssociation.group_id == group_id)
+        return query
 
     @sqlalchemy_session()
     def get_persons_by_email(self, email):
@@ -452,8 +596,14 @@ class ContactBookDB(object):
         e.g., for a person with email abc@example.com, it will return that person for both
         email='abc@example.com' and email='abc'.
 
-        Since we use SQL LIKE query to find matching persons, it's fairly straightforward to
-        extend it to find match anywhere (instead of just as prefix).
+        Prefix match is case-insensitive, and done as a half-open range query, i.e.,
+        ``SELECT ... WHERE lower(email) >= lower('<prefix>') AND lower(email) < lower('<prefix>\\uffff');``
+        which (unlike ``LIKE '<prefix>%'``) can always be answered by a range scan on an index of
+        lower(email), regardless of column collation or LIKE case-sensitivity settings. It also binds
+        `email` as a parameter, so % and _ in it are not treated as wildcards. Note that some databases
+        (e.g. sqlite) only lower-case ASCII characters.
+
+        This can be extended to find match anywhere (instead of just as prefix) using LIKE,
         i.e., ``SELECT when email LIKE '%<substr>%';``
 
         However, such queries (patterns beginning with wildcards) need to do full-table scan
@@ -471,23 +621,20 @@ class ContactBookDB(object):
         :return: List of persons
         :rtype: <list (models.Person)>
         """
-        return self.session.query(Person).filter(Person.email_addresses.any(
-            EmailAddress.email.like('{}%'.format(email)))).all()
+        return self.session.scalars(_select_persons_by_email_prefix,
+                                    {'email_from': email, 'email_to': email + '\uffff'}).all()
 
     @staticmethod
     def _find_person_details_by_prefix(prefix):
         """
         Helper method for find_person_details_by_name which only works for a single word `prefix`.
+        Returns a dict {person.id: person.full_name} of matching persons, which must not be modified.
+
+        Results are cached, as auto-complete looks up a lot of the same prefixes again (e.g. 'a', 'ab', 'abc',
+        then 'ab' again after a backspace). Keying the cache on trie's version invalidates all cached results
+        whenever trie is modified, which is rare compared to lookups.
         """
-        result = fast_trie_lookup.get_persons_by_prefix(prefix)
-        # result is a list of dicts, will possible duplicates as there may be multiple paths to a single
-        # person (e.g. via common prefix of first name & last name). We need to merge all results to remove
-        # duplicates.
-        merged = {}
-        for d in result:
-            merged.update(d)
-        # Create a list of namedtuples <FastLookupValue> from merged result
-        return list(map(lambda kv: FastLookupValue(*kv), merged.items()))
+        return _find_merged_person_details_by_prefix(normalize_name(prefix), fast_trie_lookup.version)
 
     @classmethod
     def find_person_details_by_name(cls, name):
@@ -540,11 +687,30 @@ class ContactBookDB(object):
         :rtype: <list (fast_lookup.FastLookupValue)>
         """
         if not name or len(name.split()) == 1:
-            return cls._find_person_details_by_prefix(name)
+            merged = cls._find_person_details_by_prefix(name)
+            common_ids = merged.keys()
         else:
-            result_sets = []
-            for word in name.split():
-                result_sets.append(set(cls._find_person_details_by_prefix(word)))
+            words = set(normalize_name(name).split())
+            if not words:
+                # name only consists of whitespace
+                return []
+            # A word which is a prefix of another word can't narrow down the result any further (every person
+            # matching the longer word matches it as well), so it needn't be looked up at all. Words are already
+            # normalized, so they are looked up directly instead of through _find_person_details_by_prefix.
+            trie_version = fast_trie_lookup.version
+            results = [_find_merged_person_details_by_prefix(word, trie_version) for word in words
+                       if not any(other != word and other.startswith(word) for other in words)]
             # Since we only want results which match with all words in name, we need to take intersection
-            # of merged_results (FastLookupValue overrides __eq__ so that the comparison works on id)
-            return list(set.intersection(*result_sets))
+            # of ids of all results. Starting from the smallest result keeps the intermediate set small, and
+            # intersection can be stopped as soon as it's empty.
+            results.sort(key=len)
+            merged = results[0]
+            common_ids = merged.keys()
+            for result in results[1:]:
+                # Intersecting with a dict's keys view only iterates over the smaller operand, whereas
+                # set.intersection_update(dict) would iterate over all keys of the (larger) dict
+                common_ids = common_ids & result.keys()
+                if not common_ids:
+                    break
+        # Create a list of namedtuples <FastLookupValue> only for the final result
+        return [FastLookupValue(person_id, merged[person_id]) for person_id in common_ids]
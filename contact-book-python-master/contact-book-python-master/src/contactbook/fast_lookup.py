@@ -1,8 +1,8 @@
 # encoding=utf-8
 # Author: ninadpage
 
-from collections import namedtuple
-from pytrie import SortedStringTrie
+from bisect import bisect_left, insort
+from collections import defaultdict, namedtuple
 
 
 # noinspection PyClassHasNoInit
@@ -20,77 +20,213 @@ class FastLookupValue(namedtuple('FastLookupValueNT', ['id', 'full_name'])):
         return hash(self.id)
 
 
+_MAX_CHAR = chr(0x10ffff)
+
+
+def normalize_name(name):
+    """
+    Returns the form of a name (or prefix of a name) which is used as key in lookup trie, so that lookups are
+    case-insensitive. Names must be normalized exactly once before any trie operation.
+    """
+    return name.lower()
+
+
+def _normalized_names(names):
+    """
+    Returns a set of normalized names from a person's name attributes, leaving out missing ones. A person may have
+    the same name in multiple attributes (e.g. first name & last name), which is only stored once.
+    """
+    return {normalize_name(name) for name in names if name}
+
+
+class SortedStringMap(object):
+    """
+    A str -> value mapping which supports looking up values of all keys with a given prefix, i.e. the part of a
+    trie's interface which FastTrieLookup needs.
+
+    Instead of a node object per character (like a pure Python trie), keys are kept in a sorted list, next to a
+    plain dict for exact lookups. All keys with a given prefix are then a contiguous slice of that list, whose
+    bounds are found with binary search (bisect is implemented in C). Memory needed per key is just a list slot
+    and a dict entry.
+    """
+
+    def __init__(self, mapping=None):
+        self._values = dict(mapping) if mapping else {}
+        self._keys = sorted(self._values)
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        if key not in self._values:
+            insort(self._keys, key)
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        del self._values[key]
+        del self._keys[bisect_left(self._keys, key)]
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def clear(self):
+        self._values.clear()
+        del self._keys[:]
+
+    def keys(self, prefix=''):
+        """
+        Returns all keys starting with prefix, in sorted order.
+        """
+        keys = self._keys
+        start = bisect_left(keys, prefix)
+        # Keys starting with prefix are followed by keys >= the smallest string greater than all of them, which is
+        # prefix with its last (non-maximal) character incremented
+        stripped = prefix.rstrip(_MAX_CHAR)
+        if stripped:
+            end = bisect_left(keys, stripped[:-1] + chr(ord(stripped[-1]) + 1), start)
+        else:
+            end = len(keys)
+        return keys[start:end]
+
+    def values(self, prefix=''):
+        """
+        Returns values of all keys starting with prefix, ordered by key.
+        """
+        # Looking keys up via map() keeps the loop in C. All keys match an empty prefix, so the sorted key list
+        # doesn't need to be sliced (copied) for it.
+        return list(map(self._values.__getitem__, self.keys(prefix) if prefix else self._keys))
+
+
 class FastTrieLookup(object):
 
     def __init__(self):
-        self.trie = SortedStringTrie()
+        self.trie = SortedStringMap()
+        # {person.id: (title, first_name, middle_name, last_name, suffix)} of all persons in trie, so that a
+        # person can be removed from trie without knowing (or querying) the names it was added with
+        self.person_names = {}
+        # Incremented on every modification of trie, so that results of lookups can be cached per version
+        self.version = 0
+        # Optional callable, called (without arguments) on every modification of trie, e.g. to drop results of
+        # lookups cached for previous versions
+        self.on_modified = None
+
+    def _modified(self):
+        # Must be called after (not before) a modification is complete. Lookups done while trie is being modified
+        # may see it half-updated, but they see the previous version as well, so their results are never cached
+        # for the new version.
+        self.version += 1
+        if self.on_modified is not None:
+            self.on_modified()
+
+    def clear(self):
+        """
+        Removes all persons from trie.
+        """
+        self.trie.clear()
+        self.person_names.clear()
+        self._modified()
 
     def _add_name(self, name, value_dict):
         """
-        Adds a name and associated value dict to trie.
+        Adds a (normalized) name and associated value dict to trie.
         value_dict should be a dict {person.id: person.full_name}
         """
-        name = name.lower()
-        if name in self.trie:
+        try:
             # Name already exists (maybe some other person has same first/last name)
             self.trie[name].update(value_dict)
-        else:
-            self.trie[name] = value_dict
+        except KeyError:
+            # Store a copy, as the same value_dict is passed for all names of a person, and the stored dict is
+            # updated in-place when some other person with this name is added.
+            self.trie[name] = dict(value_dict)
 
     def _delete_value_for_name(self, name, value_dict_key):
         """
-        Deletes a name's associated value_dict from trie. If given name doesn't have any more values left,
-        it is deleted as well. `value_dict_key` should be person.id.
+        Deletes a (normalized) name's associated value_dict from trie. If given name doesn't have any more values
+        left, it is deleted as well. `value_dict_key` should be person.id.
         """
-        name = name.lower()
         if name in self.trie:
             values = self.trie[name]
-            # Remove element from `values` (which is a dict) with given `value_dict_key`
+            # Remove element from `values` (which is a dict, modified in place) with given `value_dict_key`
             values.pop(value_dict_key, None)
 
-            # Check if values is empty. Delete Trie node if yes, otherwise store remaining values for given name
-            if values:
-                self.trie[name] = values
-            else:
+            # Delete the name if no values are left for it
+            if not values:
                 del self.trie[name]
         else:
             raise KeyError(name)
 
+    def build(self, entries):
+        """
+        Rebuilds the trie in one go from `entries`, an iterable of (person_id, full_name, names) tuples where names
+        are the person's name attributes (title, first name, etc; None for the missing ones).
+
+        Cheaper than calling add_person for every person, as name -> value dict mappings are collected in a plain
+        dict first, and the trie is then constructed only once.
+        """
+        name_values = defaultdict(dict)
+        person_names = {}
+        for person_id, full_name, names in entries:
+            person_names[person_id] = tuple(names)
+            for name in _normalized_names(names):
+                name_values[name][person_id] = full_name
+        self.trie = SortedStringMap(name_values)
+        self.person_names = person_names
+        self._modified()
+
     def add_person(self, person):
         """
         Adds a person's all name attributes to trie and associates them with person's value dict {id: full_name}.
         """
+        # Read all attributes only once, as every attribute access on a SQLAlchemy object goes through its
+        # instrumentation
+        names = (person.title, person.first_name, person.middle_name, person.last_name, person.suffix)
         value_dict = {person.id: person.full_name}
+        self.person_names[person.id] = names
 
-        if person.title:
-            self._add_name(person.title, value_dict)
-        if person.first_name:
-            self._add_name(person.first_name, value_dict)
-        if person.middle_name:
-            self._add_name(person.middle_name, value_dict)
-        if person.last_name:
-            self._add_name(person.last_name, value_dict)
-        if person.suffix:
-            self._add_name(person.suffix, value_dict)
+        for name in _normalized_names(names):
+            self._add_name(name, value_dict)
+        self._modified()
+
+    def update_person(self, person):
+        """
+        Updates a person's name attributes in trie, if any of them is changed since the person was added. Otherwise
+        trie is left untouched (and so are cached lookup results). Adds the person if it's not in trie yet (e.g. if
+        it was created by another process using the same database).
+        """
+        names = (person.title, person.first_name, person.middle_name, person.last_name, person.suffix)
+        # Full name (part of every value dict of the person) consists of all name attributes, so if any of them is
+        # changed, all names need to be updated
+        old_names = self.person_names.get(person.id)
+        if old_names != names:
+            if old_names is not None:
+                self.remove_person_by_id(person.id)
+            self.add_person(person)
 
     def remove_person(self, person):
         """
         Removes a persons's all name attributes and associated value dicts from trie.
         """
-        if person.title:
-            self._delete_value_for_name(person.title, person.id)
-        if person.first_name:
-            self._delete_value_for_name(person.first_name, person.id)
-        if person.middle_name:
-            self._delete_value_for_name(person.middle_name, person.id)
-        if person.last_name:
-            self._delete_value_for_name(person.last_name, person.id)
-        if person.suffix:
-            self._delete_value_for_name(person.suffix, person.id)
+        self.remove_person_by_id(person.id)
+
+    def remove_person_by_id(self, person_id):
+        """
+        Removes a persons's all name attributes and associated value dicts from trie, using the names the person
+        was added with. This works even if name attributes of the Person object are modified since.
+        Raises KeyError if person is not in trie.
+        """
+        names = self.person_names.pop(person_id)
+        for name in _normalized_names(names):
+            self._delete_value_for_name(name, person_id)
+        self._modified()
 
     def get_persons_by_prefix(self, prefix):
         """
-        Returns all value dicts which are associated with a name with given prefix.
+        Returns all value dicts which are associated with a name with given (normalized) prefix.
         """
-        prefix = prefix.lower()
         return self.trie.values(prefix)
@@ -1,11 +1,36 @@
 # encoding=utf-8
 # Author: ninadpage
 
-from sqlalchemy import Column, Integer, String, ForeignKey
-from sqlalchemy.ext.declarative import declarative_base, declared_attr
-from sqlalchemy.orm import relationship
+import operator
+import sys
+from typing import List, Optional
 
-Base = declarative_base()
+from sqlalchemy import String, ForeignKey, Index, TypeDecorator, event, func
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, validates
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+class InternedString(TypeDecorator):
+    """
+    String whose loaded values are interned, for columns which only ever hold a handful of distinct values (like
+    labels & titles), so that all rows share a single str object per value.
+    """
+    impl = String
+    cache_ok = True
+
+    def process_result_value(self, value, dialect):
+        return sys.intern(value) if value is not None else None
+
+
+# Column types, each shared by all columns of its kind instead of every column creating its own type object
+_TITLE = InternedString(length=16)
+_LABEL = InternedString(length=255)
+_SHORT_STRING = String(length=32)
+_STRING = String(length=256)
+_LONG_STRING = String(length=1024)
 
 
 class PersonGroupAssociation(Base):
@@ -15,118 +40,159 @@ class PersonGroupAssociation(Base):
     __tablename__ = 'person_group_associations'
 
     # (person_id, group_id) is the composite primary key for this table.
-    person_id = Column(Integer, ForeignKey('persons.id'), primary_key=True)
-    group_id = Column(Integer, ForeignKey('groups.id'), primary_key=True)
+    # Memberships are deleted by the database along with their person or group
+    person_id: Mapped[int] = mapped_column(ForeignKey('persons.id', ondelete='CASCADE'), primary_key=True)
+    group_id: Mapped[int] = mapped_column(ForeignKey('groups.id', ondelete='CASCADE'), primary_key=True)
+
+    # The primary key index only serves lookups by person_id; this one serves lookups of persons by group_id
+    __table_args__ = (Index('ix_pga_group_person', 'group_id', 'person_id'),)
 
 
 class Person(Base):
     __tablename__ = 'persons'
 
-    id = Column(Integer, primary_key=True)
-    title = Column(String(length=16))
-    first_name = Column(String(length=256))
-    middle_name = Column(String(length=256))
-    last_name = Column(String(length=256))
-    suffix = Column(String(length=256))
-
-    addresses = relationship("Address", back_populates="person", lazy="joined", cascade="all, delete-orphan")
-    phone_numbers = relationship("PhoneNumber", back_populates="person", lazy="joined", cascade="all, delete-orphan")
-    email_addresses = relationship("EmailAddress", back_populates="person", lazy="joined",
-                                   cascade="all, delete-orphan")
-
-    groups = relationship("Group", secondary="person_group_associations", lazy="joined", back_populates="persons")
+    id: Mapped[int] = mapped_column(primary_key=True)
+    title: Mapped[Optional[str]] = mapped_column(_TITLE)
+    first_name: Mapped[Optional[str]] = mapped_column(_STRING)
+    middle_name: Mapped[Optional[str]] = mapped_column(_STRING)
+    last_name: Mapped[Optional[str]] = mapped_column(_STRING)
+    suffix: Mapped[Optional[str]] = mapped_column(_STRING)
+
+    # Collections are loaded eagerly, each with one additional SELECT ... WHERE person_id IN (...) per query.
+    # Joining all of them into the query for persons would instead return (phones x emails x addresses x groups)
+    # rows per person.
+    # When a person is deleted, the database deletes its fields & memberships (ON DELETE CASCADE), so collections
+    # which aren't loaded aren't queried just to delete their rows (passive_deletes).
+    addresses: Mapped[List["Address"]] = relationship(back_populates="person", lazy="selectin",
+                                                      cascade="all, delete-orphan", passive_deletes=True)
+    phone_numbers: Mapped[List["PhoneNumber"]] = relationship(back_populates="person", lazy="selectin",
+                                                              cascade="all, delete-orphan", passive_deletes=True)
+    email_addresses: Mapped[List["EmailAddress"]] = relationship(back_populates="person", lazy="selectin",
+                                                                 cascade="all, delete-orphan", passive_deletes=True)
+
+    groups: Mapped[List["Group"]] = relationship(secondary="person_group_associations", lazy="selectin",
+                                                 back_populates="persons", passive_deletes=True)
+
+    # Memoized full name, reset whenever any name attribute is set, expired or refreshed
+    _full_name = None
+
+    @staticmethod
+    def make_full_name(title, first_name, middle_name, last_name, suffix):
+        """
+        Builds a full name from individual name attributes. Also usable for raw column rows without loading
+        Person objects.
+        """
+        name = ' '.join(tuple(s for s in (title, first_name, middle_name, last_name) if s is not None))
+        return f'{name}, {suffix}' if suffix else name
 
     @property
     def full_name(self):
-        return '{}{}'.format(' '.join([s for s in [self.title, self.first_name, self.middle_name, self.last_name]
-                                      if s is not None]),
-                             ', {}'.format(self.suffix) if self.suffix else '')
+        if self._full_name is None:
+            self._full_name = self.make_full_name(self.title, self.first_name, self.middle_name, self.last_name,
+                                                  self.suffix)
+        return self._full_name
+
+    # noinspection PyUnusedLocal
+    @validates('title', 'first_name', 'middle_name', 'last_name', 'suffix')
+    def _reset_full_name_on_set(self, key, value):
+        self._full_name = None
+        return value
 
     def __str__(self):
-        return '<Person> {}\nPhone numbers: {}\nEmail addresses: {}\nAddresses: {}\nGroups: {}'.format(
-            self.full_name, self.phone_numbers, self.email_addresses, self.addresses, self.groups)
+        return (f'<Person> {self.full_name}\nPhone numbers: {self.phone_numbers}\n'
+                f'Email addresses: {self.email_addresses}\nAddresses: {self.addresses}\nGroups: {self.groups}')
 
     __repr__ = __str__
 
 
+# noinspection PyUnusedLocal
+@event.listens_for(Person, 'expire')
+@event.listens_for(Person, 'refresh')
+def _reset_full_name(person, *args):
+    person._full_name = None
+
+
 class Group(Base):
     __tablename__ = 'groups'
 
-    id = Column(Integer, primary_key=True)
-    name = Column(String(length=256))
+    id: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[Optional[str]] = mapped_column(_STRING)
 
-    persons = relationship("Person", secondary='person_group_associations', lazy="joined", back_populates="groups")
+    # Groups may have lots of members which are rarely needed along with the group, so they are only loaded when
+    # accessed
+    persons: Mapped[List["Person"]] = relationship(secondary='person_group_associations',
+                                                   back_populates="groups", passive_deletes=True)
 
     def __str__(self):
-        return '<Group> {}'.format(self.name)
+        return f'<Group> {self.name}'
 
     __repr__ = __str__
 
 
-class AbstractField(Base):
+class FieldMixin(object):
     """
-    Abstract class for all fields in a contact (phone numbers, emails, addresses, notes, etc).
+    Mixin for all fields in a contact (phone numbers, emails, addresses, notes, etc).
     All fields belong to (have a many-to-one relationship with) Person and all have a label (e.g. 'Home' number,
     'Mobile' number, 'Word' address, etc).
     """
-    __abstract__ = True
+    id: Mapped[int] = mapped_column(primary_key=True)
+    label: Mapped[Optional[str]] = mapped_column(_LABEL)
+
+    # Indexed, as fields are always loaded (and deleted) by person
+    person_id: Mapped[Optional[int]] = mapped_column(ForeignKey('persons.id', ondelete='CASCADE'), index=True)
 
-    id = Column(Integer, primary_key=True)
-    label = Column(String(length=255))
 
-    # noinspection PyMethodParameters
-    @declared_attr
-    def person_id(cls):
-        return Column(Integer, ForeignKey('persons.id'))
+_address_parts = operator.attrgetter('street_name', 'house_number', 'address_line_1', 'address_line_2',
+                                     'postal_code', 'city', 'country')
 
 
-class Address(AbstractField):
+class Address(FieldMixin, Base):
     __tablename__ = 'addresses'
 
-    house_number = Column(String(length=32))
-    street_name = Column(String(length=256))
-    address_line_1 = Column(String(length=1024))
-    address_line_2 = Column(String(length=1024))
-    city = Column(String(length=256))
-    postal_code = Column(String(length=32))
-    country = Column(String(length=256))
+    house_number: Mapped[Optional[str]] = mapped_column(_SHORT_STRING)
+    street_name: Mapped[Optional[str]] = mapped_column(_STRING)
+    address_line_1: Mapped[Optional[str]] = mapped_column(_LONG_STRING)
+    address_line_2: Mapped[Optional[str]] = mapped_column(_LONG_STRING)
+    city: Mapped[Optional[str]] = mapped_column(_STRING)
+    postal_code: Mapped[Optional[str]] = mapped_column(_SHORT_STRING)
+    country: Mapped[Optional[str]] = mapped_column(_STRING)
 
-    person = relationship("Person", back_populates="addresses", single_parent=True, lazy="joined",
-                          cascade="all, delete-orphan")
+    person: Mapped[Optional["Person"]] = relationship(back_populates="addresses")
 
     def __str__(self):
-        return '<Address> {}: {}'.format(self.label if self.label else 'No label',
-                                         ', '.join([s for s in [self.street_name, self.house_number,
-                                                                self.address_line_1, self.address_line_2,
-                                                                self.postal_code, self.city, self.country]
-                                                    if s is not None]))
+        parts = ', '.join([s for s in _address_parts(self) if s is not None])
+        return f'<Address> {self.label or "No label"}: {parts}'
 
     __repr__ = __str__
 
 
-class PhoneNumber(AbstractField):
+class PhoneNumber(FieldMixin, Base):
     __tablename__ = 'phone_numbers'
 
-    phone = Column(String(length=256), nullable=False)
+    # Indexed for lookups by phone number
+    phone: Mapped[str] = mapped_column(_STRING, index=True)
 
-    person = relationship("Person", back_populates="phone_numbers", single_parent=True, lazy="joined",
-                          cascade="all, delete-orphan")
+    person: Mapped[Optional["Person"]] = relationship(back_populates="phone_numbers")
 
     def __str__(self):
-        return '<PhoneNumber> {}: {}'.format(self.label if self.label else 'No label', self.phone)
+        return f'<PhoneNumber> {self.label or "No label"}: {self.phone}'
 
     __repr__ = __str__
 
 
-class EmailAddress(AbstractField):
+class EmailAddress(FieldMixin, Base):
     __tablename__ = 'email_addresses'
 
-    email = Column(String(length=256), nullable=False)
+    # Persons are looked up by (case-insensitive prefix of) email address, see index below
+    email: Mapped[str] = mapped_column(_STRING)
 
-    person = relationship("Person", back_populates="email_addresses", single_parent=True, lazy="joined",
-                          cascade="all, delete-orphan")
+    person: Mapped[Optional["Person"]] = relationship(back_populates="email_addresses")
 
     def __str__(self):
-        return '<EmailAddress> {}: {}'.format(self.label if self.label else 'No label', self.email)
+        return f'<EmailAddress> {self.label or "No label"}: {self.email}'
 
     __repr__ = __str__
+
+
+# Expression index on lower-cased email, as that is what ContactBookDB.get_persons_by_email compares
+Index('ix_email_addresses_email_lower', func.lower(EmailAddress.email))
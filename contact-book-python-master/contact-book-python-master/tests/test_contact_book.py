@@ -6,10 +6,17 @@ import logging
 import logging.config
 import sys
 import os
+import tempfile
+import threading
+
+from sqlalchemy import MetaData, create_engine, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import QueuePool
 
 from contactbook import init_contactbook, ContactBookDB
-from contactbook import models
+from contactbook import db, models
 from contactbook.db import fast_trie_lookup
+from contactbook.fast_lookup import SortedStringMap
 from contactbook.exceptions import NoSuchObjectFound
 
 
@@ -36,16 +43,24 @@ logging_config = {
     },
 }
 
-logging.config.dictConfig(logging_config)
 logger = logging.getLogger('cb_test_logger')
+# Only emit logs when asked to, otherwise discard them (instead of falling back to logging's last resort handler)
+if os.environ.get('CB_VERBOSE_TESTS'):
+    logging.config.dictConfig(logging_config)
+else:
+    logger.addHandler(logging.NullHandler())
 
 
 class TestContactBook(unittest.TestCase):
 
-    TEST_DB_PATH = 'test.db'
+    # Named in-memory database which is shared by all connections of the process (and kept as long as any of them
+    # is open), so that it survives re-initialization of contact book within a test
+    TEST_DB_URL = 'sqlite:///file:contactbook_test?mode=memory&cache=shared&uri=true'
 
-    def setUp(self):
-        init_contactbook(sqlite_db_path=self.TEST_DB_PATH, logger=logger)
+    @classmethod
+    def setUpClass(cls):
+        # Schema is created only once, tests share it and only their rows are removed after each of them
+        init_contactbook(db_connection_string=cls.TEST_DB_URL, logger=logger)
 
     def test_trie_initialization(self):
         # Prepare initial state
@@ -54,8 +69,8 @@ class TestContactBook(unittest.TestCase):
         p2 = cb.create_person(first_name='Tuv', last_name='Xyz')
 
         # Reinitialize contact book
-        fast_trie_lookup.trie.clear()
-        init_contactbook(sqlite_db_path=self.TEST_DB_PATH, logger=logger)
+        fast_trie_lookup.clear()
+        init_contactbook(db_connection_string=self.TEST_DB_URL, logger=logger)
 
         # Test if trie is initialized properly
         r1 = cb.find_person_details_by_name('')
@@ -69,6 +84,8 @@ class TestContactBook(unittest.TestCase):
         self.assertEqual(len(r3), 1)
         self.assertEqual(r3[0].id, p2.id)
 
+        self.assertEqual(cb.find_person_details_by_name(' '), [])
+
     def test_create_person(self):
         cb = ContactBookDB()
 
@@ -102,6 +119,7 @@ class TestContactBook(unittest.TestCase):
         nonexistant_group_id = g1.id + 2
         with self.assertRaises(NoSuchObjectFound):
             cb.create_person(first_name='Tuv', last_name='Xyz', group_id=nonexistant_group_id)
+        self.assertEqual(len(cb.get_all_persons()), 2)
 
     def test_groups(self):
         cb = ContactBookDB()
@@ -120,6 +138,9 @@ class TestContactBook(unittest.TestCase):
         p6 = cb.create_person(first_name='P6', group_id=g1.id)
         cb.add_group_to_person(p6.id, g2.id)
 
+        # Returned persons are detached, so groups added since are only seen after loading them again
+        self.assertEqual(p3.groups, [])
+        p1, p2, p3, p4, p5, p6 = (cb.get_person_by_id(p.id) for p in (p1, p2, p3, p4, p5, p6))
         self.assertEqual(len(p1.groups), 1)
         self.assertEqual(len(p4.groups), 1)
         self.assertEqual(len(p6.groups), 2)
@@ -131,6 +152,13 @@ class TestContactBook(unittest.TestCase):
         self.assertEqual(p5.groups[0].id, g2.id)
         self.assertEqual(p6.groups[0].id, g1.id)
         self.assertEqual(p6.groups[1].id, g2.id)
+        self.assertSetEqual({p.id for p in cb.get_group_by_id(g2.id).persons}, {p4.id, p5.id, p6.id})
+
+        # A failing commit is rolled back, so that it doesn't affect later calls
+        with self.assertRaises(IntegrityError):
+            cb.add_group_to_person(p1.id, g1.id)
+        self.assertIsInstance(ContactBookDB().create_group('G3'), models.Group)
+        self.assertEqual(len(cb.get_all_persons(group_id=g1.id)), 4)
 
     def test_get_all_persons(self):
         cb = ContactBookDB()
@@ -159,12 +187,21 @@ class TestContactBook(unittest.TestCase):
         self.assertEqual(len(res), 3)
         self.assertSetEqual(set(map(lambda p: p.id, res)), {p4.id, p5.id, p6.id})
 
+        res = cb.get_all_persons(group_id=g2.id, only_names=True)
+        self.assertEqual(len(res), 3)
+        self.assertSetEqual(set(map(lambda p: p.full_name, res)), {'P4', 'P5', 'P6'})
+        # Partially loaded persons aren't returned by later calls instead of fully loaded ones
+        self.assertEqual(cb.get_person_by_id(p4.id).phone_numbers, [])
+        cb.delete_person(p5.id)
+        self.assertEqual(len(cb.get_all_persons(group_id=g2.id)), 2)
+
     def test_add_fields(self):
         cb = ContactBookDB()
         p = cb.create_person(first_name='P', last_name='L')
 
         ph1 = cb.add_phone_number(p.id, '+31600012345')
         ph2 = cb.add_phone_number(p.id, '+31600012346', 'Work')
+        p = cb.get_person_by_id(p.id)
         self.assertEqual(len(p.phone_numbers), 2)
         self.assertEqual(set(map(lambda ph: ph.id, p.phone_numbers)), {ph1.id, ph2.id})
         for ph in p.phone_numbers:
@@ -174,6 +211,7 @@ class TestContactBook(unittest.TestCase):
 
         em1 = cb.add_email_address(p.id, 'abc@example.com')
         em2 = cb.add_email_address(p.id, 'abc@work.com', 'Work')
+        p = cb.get_person_by_id(p.id)
         self.assertEqual(len(p.email_addresses), 2)
         self.assertSetEqual(set(map(lambda em: em.id, p.email_addresses)), {em1.id, em2.id})
         for em in p.email_addresses:
@@ -185,6 +223,7 @@ class TestContactBook(unittest.TestCase):
         ad2 = cb.add_address(p.id, house_number='102', street_name='Kiwi', address_line_1='AL1',
                              address_line_2='AL2', city='Auckland', postal_code='10236', country='NZ',
                              address_label='Work')
+        p = cb.get_person_by_id(p.id)
         self.assertEqual(len(p.addresses), 2)
         self.assertSetEqual(set(map(lambda ad: ad.id, p.addresses)), {ad1.id, ad2.id})
         for ad in p.addresses:
@@ -201,6 +240,10 @@ class TestContactBook(unittest.TestCase):
             "Groups: []"
         self.assertEqual(str(p), str_repr)
 
+        # Deleting a field must not delete the person it belongs to
+        cb.delete_phone_number(ph1.id)
+        self.assertEqual([ph.id for ph in cb.get_person_by_id(p.id).phone_numbers], [ph2.id])
+
     def test_trie_lookup(self):
         cb = ContactBookDB()
         g1 = cb.create_group('G1')
@@ -221,7 +264,12 @@ class TestContactBook(unittest.TestCase):
             if r.id == p1.id:
                 p = cb.get_person_by_id(r.id)
                 self.assertEqual(p.full_name, p1.full_name)
-                self.assertEqual(p.email_addresses, p1.email_addresses)
+                self.assertEqual([em.id for em in p.email_addresses], [em.id for em in p1.email_addresses])
+
+        # Persons sharing a name must not leak into lookups of each other's other names
+        res = cb.find_person_details_by_name('Xyz')
+        self.assertEqual(len(res), 1)
+        self.assertSetEqual({res[0].id}, {p2.id})
 
         # Test updating trie after deletion of persons
         res = cb.find_person_details_by_name('Def')
@@ -246,10 +294,19 @@ class TestContactBook(unittest.TestCase):
 
         p1.last_name = 'Spoon'
         cb.save_object(p1)
+        res = cb.find_person_details_by_name('Xyzzy')
+        self.assertEqual(len(res), 1)
+        self.assertEqual((res[0].id, res[0].full_name), (p1.id, 'Xyzzy Spoon'))
         res = cb.find_person_details_by_name('ab')
         self.assertEqual(len(res), 1)
         self.assertSetEqual({res[0].id}, {p2.id})
 
+        # Saving a person without changing any name leaves trie untouched
+        trie_version = fast_trie_lookup.version
+        cb.save_object(p1)
+        self.assertEqual(fast_trie_lookup.version, trie_version)
+        self.assertEqual(len(cb.find_person_details_by_name('Xyzzy')), 1)
+
         # Test non-duplicate results (e.g. when both first name & last name match a prefix)
         p4 = cb.create_person(first_name='Pqrs', last_name='Pqr')
         p5 = cb.create_person(first_name='Xy', last_name='Pqr')
@@ -274,6 +331,27 @@ class TestContactBook(unittest.TestCase):
         res = cb.find_person_details_by_name('ab hi c')
         self.assertEqual(len(res), 0)
 
+        res = cb.find_person_details_by_name('Ab hi abe')
+        self.assertEqual(len(res), 1)
+        self.assertSetEqual({res[0].id}, {p3.id})
+
+    def test_sorted_string_map(self):
+        m = SortedStringMap({'abc': 1, 'abd': 2, 'b': 3})
+        m['ab'] = 4
+        m['a\U0010ffff'] = 5
+        self.assertEqual(m.keys(), ['ab', 'abc', 'abd', 'a\U0010ffff', 'b'])
+        self.assertEqual(m.values('ab'), [4, 1, 2])
+        self.assertEqual(m.values('abc'), [1])
+        self.assertEqual(m.values('a\U0010ffff'), [5])
+        self.assertEqual(m.values('c'), [])
+
+        del m['abc']
+        self.assertNotIn('abc', m)
+        self.assertEqual(m.values('ab'), [4, 2])
+        m.clear()
+        self.assertEqual(len(m), 0)
+        self.assertEqual(m.values(), [])
+
     def test_get_persons_by_email(self):
         cb = ContactBookDB()
         p1 = cb.create_person(first_name='P1', email_address='abc@example.com')
@@ -288,6 +366,10 @@ class TestContactBook(unittest.TestCase):
         self.assertEqual(len(res), 2)
         self.assertSetEqual({res[0].id, res[1].id}, {p1.id, p3.id})
 
+        res = cb.get_persons_by_email('ABC@Example')
+        self.assertEqual(len(res), 1)
+        self.assertSetEqual({res[0].id}, {p1.id})
+
         cb.add_email_address(p2.id, 'abc@example.com')
         res = cb.get_persons_by_email('abc@example.com')
         self.assertEqual(len(res), 2)
@@ -308,10 +390,129 @@ class TestContactBook(unittest.TestCase):
                           res[0].email_addresses[0].email, res[0].groups[0].id),
                          ('Abc', 'Xyz', '+31600012345', 'abc@example.com', g1.id))
 
+    def test_sessions(self):
+        cb = ContactBookDB()
+        p = cb.create_person(first_name='Old', phone_number='+31600012345')
+
+        def update_person():
+            other_cb = ContactBookDB()
+            person = other_cb.get_person_by_id(p.id)
+            person.first_name = 'New'
+            other_cb.save_object(person)
+            other_cb.add_phone_number(p.id, '+31600012346')
+
+        # Changes done in another thread are seen by later calls
+        thread = threading.Thread(target=update_person)
+        thread.start()
+        thread.join()
+        p = ContactBookDB().get_person_by_id(p.id)
+        self.assertEqual((p.first_name, len(p.phone_numbers)), ('New', 2))
+        self.assertEqual(len(cb.get_all_persons()[0].phone_numbers), 2)
+
+        # Changes to returned objects are only written by save_object, not by any later call
+        p.first_name = 'Zed'
+        ContactBookDB().create_group('G1')
+        self.assertEqual(cb.get_person_by_id(p.id).first_name, 'New')
+        self.assertEqual([r.id for r in cb.find_person_details_by_name('new')], [p.id])
+
+    def test_trie_lookup_during_modification(self):
+        cb = ContactBookDB()
+        add_name = fast_trie_lookup._add_name
+
+        # Look up names while trie is being modified (like another thread could), which must not leave a result
+        # of the half-updated trie cached
+        def add_name_and_look_up(name, value_dict):
+            cb.find_person_details_by_name('qq')
+            add_name(name, value_dict)
+
+        fast_trie_lookup._add_name = add_name_and_look_up
+        try:
+            p = cb.create_person(first_name='Qqq')
+        finally:
+            del fast_trie_lookup._add_name
+        self.assertEqual([r.id for r in cb.find_person_details_by_name('qq')], [p.id])
+
+    def test_save_object(self):
+        cb = ContactBookDB()
+        p = cb.create_person(first_name='Abc')
+        # Like a person created by another process using the same database, which isn't in trie of this one
+        fast_trie_lookup.remove_person(p)
+
+        p.first_name = 'Def'
+        cb.save_object(p)
+        self.assertEqual(cb.get_person_by_id(p.id).first_name, 'Def')
+        self.assertEqual([r.id for r in cb.find_person_details_by_name('def')], [p.id])
+
+        with self.assertRaises(NoSuchObjectFound):
+            cb.save_object(models.Person(id=p.id + 1, first_name='Ghi'))
+        self.assertEqual(len(cb.get_all_persons()), 1)
+        self.assertEqual(cb.find_person_details_by_name('ghi'), [])
+
+    def test_sqlite_file_database(self):
+        with tempfile.TemporaryDirectory() as directory:
+            try:
+                init_contactbook(sqlite_db_path=os.path.join(directory, 'test.db'), logger=logger,
+                                 engine_options={'pool_timeout': 5})
+                with db.sqlalchemy_engine.connect() as connection:
+                    self.assertEqual(connection.exec_driver_sql('PRAGMA journal_mode').scalar(), 'wal')
+                    self.assertEqual(connection.exec_driver_sql('PRAGMA foreign_keys').scalar(), 1)
+                # Default pool options, except the overridden one
+                pool = db.sqlalchemy_engine.pool
+                self.assertIsInstance(pool, QueuePool)
+                self.assertEqual((pool.size(), pool.timeout()), (10, 5))
+
+                p = ContactBookDB().create_person(first_name='Abc', phone_number='+31600012345')
+                self.assertEqual(len(ContactBookDB().get_person_by_id(p.id).phone_numbers), 1)
+            finally:
+                init_contactbook(db_connection_string=self.TEST_DB_URL, logger=logger)
+
+    def test_delete_person_without_cascading_foreign_keys(self):
+        # Tables as created before foreign keys were declared with ON DELETE CASCADE
+        metadata = MetaData()
+        for table in models.Base.metadata.sorted_tables:
+            table.to_metadata(metadata)
+            for constraint in metadata.tables[table.name].foreign_key_constraints:
+                constraint.ondelete = None
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'test.db')
+            engine = create_engine('sqlite:///{}'.format(path))
+            metadata.create_all(engine)
+            engine.dispose()
+            try:
+                init_contactbook(sqlite_db_path=path, logger=logger)
+                self.assertFalse(db.database_cascades_deletes)
+
+                cb = ContactBookDB()
+                g1 = cb.create_group('G1')
+                p1 = cb.create_person(first_name='P1', phone_number='+31600012345', email_address='abc@example.com',
+                                      group_id=g1.id)
+                cb.add_address(p1.id, city='Auckland')
+                p2 = cb.create_person(first_name='P2', phone_number='+31600012346', group_id=g1.id)
+
+                cb.delete_person(p1.id)
+                self.assertEqual([p.id for p in cb.get_all_persons()], [p2.id])
+                self.assertEqual([p.id for p in cb.get_all_persons(group_id=g1.id)], [p2.id])
+                # No fields of the deleted person are left behind
+                with db.sqlalchemy_engine.connect() as connection:
+                    for model in (models.PhoneNumber, models.EmailAddress, models.Address):
+                        self.assertEqual(connection.execute(select(model.id).where(model.person_id == p1.id)).all(),
+                                         [])
+                self.assertEqual(len(cb.get_person_by_id(p2.id).phone_numbers), 1)
+                cb.delete_group(g1.id)
+                self.assertEqual(cb.get_person_by_id(p2.id).groups, [])
+            finally:
+                init_contactbook(db_connection_string=self.TEST_DB_URL, logger=logger)
+
     def tearDown(self):
-        fast_trie_lookup.trie.clear()
-        if os.path.exists(self.TEST_DB_PATH):
-            os.remove(self.TEST_DB_PATH)
+        fast_trie_lookup.clear()
+        # Delete all rows (children before parents), so that the next test starts with an empty database
+        with db.sqlalchemy_engine.begin() as connection:
+            for table in reversed(models.Base.metadata.sorted_tables):
+                connection.execute(table.delete())
+
+    @classmethod
+    def tearDownClass(cls):
+        models.Base.metadata.drop_all(db.sqlalchemy_engine)
 
 
 if __name__ == '__main__':